@@ -256,6 +256,7 @@ def get_fn_conditions(fn: Callable, self_type: Optional[type] = None) -> Optiona
     if isinstance(fn, types.BuiltinFunctionType):
         return Conditions([], [], frozenset(), sig, frozenset(), [])
     filename = inspect.getsourcefile(fn) or ''
+    namespace = fn_globals(fn)
     lines = list(get_doc_lines(fn))
     parse = parse_sections(lines, ('pre', 'post', 'raises'), filename)
     pre = []
@@ -267,7 +268,7 @@ def get_fn_conditions(fn: Callable, self_type: Optional[type] = None) -> Optiona
                                  for expr in parse.mutable_expr.split(',')
                                  if expr != '')
     for line_num, expr in parse.sections['pre']:
-        pre.append(ConditionExpr(filename, line_num, expr, fn_globals(fn)))
+        pre.append(ConditionExpr(filename, line_num, expr, namespace))
     for line_num, expr in parse.sections['raises']:
         for exc_source in expr.split(','):
             try:
@@ -283,7 +284,7 @@ def get_fn_conditions(fn: Callable, self_type: Optional[type] = None) -> Optiona
                 continue
             raises.add(exc_type)
     for line_num, expr in parse.sections['post']:
-        post_conditions.append(ConditionExpr(filename, line_num, expr, fn_globals(fn)))
+        post_conditions.append(ConditionExpr(filename, line_num, expr, namespace))
 
     return Conditions(pre, post_conditions, frozenset(raises), sig,
                       mutable_args, parse.syntax_messages)
@@ -1,17 +1,28 @@
+import ast
 import builtins
 import contextlib
 import copy
 import inspect
 import functools
+import operator
+import os
 import sys
+import threading
 import traceback
 import types
+import weakref
+from dataclasses import dataclass
 from typing import *
 
-from crosshair.condition_parser import Conditions, get_fn_conditions, ClassConditions, get_class_conditions, fn_globals
+from crosshair.condition_parser import ConditionExpr, Conditions, get_fn_conditions, ClassConditions, get_class_conditions, fn_globals
 from crosshair.util import IdentityWrapper, AttributeHolder
 
 
+# Setting CROSSHAIR_ENFORCE=0 makes enforcement contexts leave functions
+# unwrapped, so that merely entering one costs nothing per call.
+_ENABLED = os.environ.get('CROSSHAIR_ENFORCE') != '0'
+
+
 class PreconditionFailed(BaseException):
     pass
 
@@ -20,67 +31,311 @@ class PostconditionFailed(BaseException):
     pass
 
 
+def _find_function(cls: type, name: str) -> Optional[types.FunctionType]:
+    ''' Finds the plain function that `cls.<name>` resolves to, if any. '''
+    for klass in cls.__mro__:
+        if name in vars(klass):
+            value = vars(klass)[name]
+            return value if isinstance(value, types.FunctionType) else None
+    return None
+
+
 def is_singledispatcher(fn: Callable) -> bool:
-    return hasattr(fn, 'registry') and isinstance(fn.registry, Mapping)  # type: ignore
+    # functools.singledispatch exposes its registry as a mappingproxy; an exact
+    # type check avoids the (slow) ABC-based isinstance(..., Mapping).
+    return type(getattr(fn, 'registry', None)) is types.MappingProxyType
+
+
+# Weak keys mean a reused id() can never return another function's conditions.
+# But the stored conditions hold their namespace (usually the module globals),
+# which normally refers back to the function. So in practice entries live as
+# long as their module does, and this is an unbounded cache like the @memo on
+# get_class_conditions().
+_FN_CONDITIONS: MutableMapping[Callable, Optional[Conditions]] = weakref.WeakKeyDictionary()
+
+
+def cached_fn_conditions(fn: Callable) -> Optional[Conditions]:
+    '''
+    Like get_fn_conditions(), but remembers the result, so that repeated
+    enforcement contexts over the same environment do not re-parse every
+    docstring.
+    '''
+    try:
+        return _FN_CONDITIONS[fn]
+    except KeyError:
+        pass
+    except TypeError:  # not weakly referenceable (e.g. builtins)
+        return get_fn_conditions(fn)
+    conditions = get_fn_conditions(fn)
+    _FN_CONDITIONS[fn] = conditions
+    return conditions
+
+
+_POST_NAMES = ('__return__', '_', '__old__')
+
+
+@dataclass(frozen=True)
+class Conjunct:
+    check: Callable
+    condition: ConditionExpr
+    source: str
+    # The names that `check` takes as (positional) parameters:
+    params: Tuple[str, ...]
+    # Attributes read from __old__, or None if __old__ is used some other way:
+    old_names: Optional[FrozenSet[str]]
+
+
+# (python 3.7 parses True as a NameConstant; later versions use Constant and
+# deprecate NameConstant)
+_CONSTANT_NODES: Tuple[type, ...] = (
+    (ast.Constant, ast.NameConstant) if sys.version_info < (3, 8) else (ast.Constant,))
+
+
+def _is_true_constant(node: ast.AST) -> bool:
+    return isinstance(node, _CONSTANT_NODES) and node.value is True  # type: ignore
+
+
+def _old_attributes(node: ast.AST) -> Optional[FrozenSet[str]]:
+    attrs: Set[str] = set()
+    old_references = 0
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and n.id == '__old__':
+            old_references += 1
+        elif (isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name) and
+              n.value.id == '__old__'):
+            attrs.add(n.attr)
+            old_references -= 1
+    return frozenset(attrs) if old_references == 0 else None
+
+
+def compile_conjuncts(condition: ConditionExpr, available_names: Sequence[str],
+                      namespace: Dict[str, object]) -> List[Conjunct]:
+    '''
+    Splits a condition at its top-level "and"s and compiles each part into a
+    function that takes, positionally, just those of the available names that
+    the part refers to. Everything else resolves in the given namespace, so
+    that checks need no namespace dictionary on every call.
+    Conjuncts that are literally True are dropped.
+    '''
+    source = condition.expr_source
+    body = ast.parse(source, mode='eval').body
+    if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And):
+        parts = body.values
+    else:
+        parts = [body]
+    conjuncts = []
+    for part in parts:
+        if _is_true_constant(part):
+            continue
+        names = {n.id for n in ast.walk(part) if isinstance(n, ast.Name)}
+        params = tuple(n for n in available_names if n in names)
+        tree = ast.parse('lambda {}: None'.format(', '.join(params)), mode='eval')
+        cast(ast.Lambda, tree.body).body = part
+        check = eval(compile(tree, '<string>', 'eval'), namespace)
+        part_source = source
+        if len(parts) > 1 and hasattr(ast, 'get_source_segment'):  # python >= 3.8
+            part_source = ast.get_source_segment(source, part) or part_source
+        conjuncts.append(Conjunct(check, condition, part_source, params,
+                                  _old_attributes(part)))
+    return conjuncts
+
+
+def _render_params(signature: inspect.Signature, prefix: str,
+                   helpers: Dict[str, object]) -> Tuple[str, str]:
+    '''
+    Renders the parameter list of a function with the given signature as
+    well as the argument list that forwards those parameters to another
+    function with the same signature. Default values are placed in `helpers`.
+    '''
+    params: List[str] = []
+    call_args: List[str] = []
+    seen_star = False
+    last_positional_only = 0
+    for param in signature.parameters.values():
+        name = param.name
+        if param.kind == inspect.Parameter.VAR_POSITIONAL:
+            params.append('*' + name)
+            call_args.append('*' + name)
+            seen_star = True
+            continue
+        if param.kind == inspect.Parameter.VAR_KEYWORD:
+            params.append('**' + name)
+            call_args.append('**' + name)
+            continue
+        if param.kind == inspect.Parameter.KEYWORD_ONLY:
+            if not seen_star:
+                params.append('*')
+                seen_star = True
+            call_args.append(f'{name}={name}')
+        else:
+            call_args.append(name)
+        if param.default is inspect.Parameter.empty:
+            params.append(name)
+        else:
+            default_name = f'{prefix}default_{name}'
+            helpers[default_name] = param.default
+            params.append(f'{name}={default_name}')
+        if param.kind == inspect.Parameter.POSITIONAL_ONLY:
+            last_positional_only = len(params)
+    if last_positional_only:
+        # (python functions only have positional-only parameters on 3.8+,
+        # where this syntax is available)
+        params.insert(last_positional_only, '/')
+    return ', '.join(params), ', '.join(call_args)
+
+
+def _old_values_type(names: Sequence[str]) -> type:
+    '''
+    Makes a tuple type that exposes its items as the given attributes.
+    Used for `__old__` when conditions only read attributes from it;
+    building a tuple is cheaper than filling a namespace on every call.
+    '''
+    attrs: Dict[str, object] = {'__slots__': ()}
+    for i, name in enumerate(names):
+        attrs[name] = property(operator.itemgetter(i))
+    return type('OldValues', (tuple,), attrs)
+
+
+def _bracket_checks(check_lines: List[str], prefix: str) -> List[str]:
+    '''
+    While a function's conditions are checked, calls to that same function
+    are left unchecked.
+    '''
+    return [f'    {prefix}enforcing.add({prefix}fn_id)',
+            '    try:',
+            *check_lines,
+            '    finally:',
+            f'        {prefix}enforcing.discard({prefix}fn_id)']
 
 
 def EnforcementWrapper(fn: Callable, conditions: Conditions, enforced: 'EnforcedConditions') -> Callable:
+    '''
+    Generates a wrapper with the same signature as the given function, which
+    checks the function's conditions around each call.
+
+    Like dataclass-generated methods, the wrapper source is specialized to
+    the signature and conditions, so that calls involve no argument binding
+    or namespace dictionaries.
+    '''
     signature = conditions.sig
+    param_names = tuple(signature.parameters)
+    namespace = fn_globals(fn)
+    preconditions = [conjunct for c in conditions.pre if c.expr is not None
+                     for conjunct in compile_conjuncts(c, param_names, namespace)]
+    # (in postconditions, the special names shadow any parameters of the same name)
+    post_names = [n for n in param_names if n not in _POST_NAMES] + list(_POST_NAMES)
+    postconditions = [conjunct for c in conditions.post if c.expr is not None
+                      for conjunct in compile_conjuncts(c, post_names, namespace)]
+    needed_old: Set[str] = set()
+    uses_old = False
+    old_as_namespace = False
+    for postcondition in postconditions:
+        if '__old__' not in postcondition.params:
+            continue
+        uses_old = True
+        if postcondition.old_names is None:
+            old_as_namespace = True
+            needed_old.update(param_names)
+        else:
+            if not postcondition.old_names.issubset(param_names):
+                # Reading a non-parameter must fail just like it does on an
+                # AttributeHolder (rather than finding a tuple member):
+                old_as_namespace = True
+            needed_old.update(postcondition.old_names)
+    old_names = [n for n in param_names if n in needed_old]
+    mutable_args = conditions.mutable_args or frozenset()
+    unknown_mutable_args = mutable_args - set(param_names)
+
+    # Helper names must not be shadowed by any of the parameters:
+    p = '_crosshair_'
+    while any(name.startswith(p) for name in param_names):
+        p = '_' + p
+    helpers: Dict[str, object] = {
+        p + 'fn': fn,
+        p + 'state': enforced.state,
+        p + 'fn_id': id(fn),
+        p + 'copy': copy.copy,
+        p + 'AttributeHolder': AttributeHolder,
+        p + 'PreconditionFailed': PreconditionFailed,
+        p + 'PostconditionFailed': PostconditionFailed,
+    }
+    params_src, call_args_src = _render_params(signature, p, helpers)
+    call_src = f'{p}fn({call_args_src})'
+    locals_for_names = {'__return__': p + 'ret', '_': p + 'ret', '__old__': p + 'old'}
 
-    def wrapper(*a, **kw):
-        fns_enforcing = enforced.fns_enforcing
-        if fns_enforcing is None or fn in fns_enforcing:
-            return fn(*a, **kw)
-        #print('Calling enforcement wrapper ', fn)
-        bound_args = signature.bind(*a, **kw)
-        bound_args.apply_defaults()
-        old = {}
-        mutable_args = conditions.mutable_args
-        mutable_args_remaining = set(mutable_args) if mutable_args is not None else set()
-        for argname, argval in bound_args.arguments.items():
-            old[argname] = copy.copy(argval)
-            if argname in mutable_args_remaining:
-                mutable_args_remaining.remove(argname)
-        if mutable_args_remaining:
-            raise PostconditionFailed('Unrecognized mutable argument(s) in postcondition: "{}"'.format(
-                ','.join(mutable_args_remaining)))
-        with enforced.currently_enforcing(fn):
-            for precondition in conditions.pre:
-                #print(' precondition eval ', precondition.expr_source)
-                args = {**fn_globals(fn), **bound_args.arguments}
-                if not eval(precondition.expr, args):
-                    raise PreconditionFailed(
-                        f'Precondition "{precondition.expr_source}" was not satisfied '
-                        f'before calling "{fn.__name__}"')
-        ret = fn(*a, **kw)
-        with enforced.currently_enforcing(fn):
-            lcls = {**bound_args.arguments, '__return__': ret,
-                    '_': ret, '__old__': AttributeHolder(old)}
-            args = {**fn_globals(fn), **lcls}
-            for postcondition in conditions.post:
-                #print(' postcondition eval ', postcondition.expr_source, fn, lcls['_'])
-                if postcondition.expr and not eval(postcondition.expr, args):
-                    raise PostconditionFailed('Postcondition failed at {}:{}'.format(
-                        postcondition.filename, postcondition.line))
-        #print('Completed enforcement wrapper ', fn)
-        return ret
-    return wrapper
+    def post_args_for(conjunct: Conjunct) -> str:
+        return ', '.join(locals_for_names.get(n, n) for n in conjunct.params)
+    lines = [
+        f'def wrapper({params_src}):',
+        f'    {p}enforcing = {p}state.fns_enforcing',
+        f'    if {p}enforcing is None or {p}fn_id in {p}enforcing:',
+        f'        return {call_src}',
+    ]
+    if unknown_mutable_args:
+        helpers[p + 'mutable_msg'] = 'Unrecognized mutable argument(s) in postcondition: "{}"'.format(
+            ','.join(unknown_mutable_args))
+        lines.append(f'    raise {p}PostconditionFailed({p}mutable_msg)')
+    check_lines = []
+    for i, precondition in enumerate(preconditions):
+        helpers[f'{p}pre{i}'] = precondition.check
+        helpers[f'{p}pre{i}_msg'] = (
+            f'Precondition "{precondition.source}" was not satisfied '
+            f'before calling "{fn.__name__}"')
+        check_lines.append(f'        if not {p}pre{i}({", ".join(precondition.params)}):')
+        check_lines.append(f'            raise {p}PreconditionFailed({p}pre{i}_msg)')
+    if check_lines:
+        lines.extend(_bracket_checks(check_lines, p))
+    if uses_old:
+        # Take snapshots only once the preconditions have passed:
+        if old_as_namespace:
+            old_items = ', '.join(f'{name!r}: {p}copy({name})' for name in old_names)
+            lines.append(f'    {p}old = {p}AttributeHolder({{{old_items}}})')
+        else:
+            helpers[p + 'OldValues'] = _old_values_type(old_names)
+            old_items = ''.join(f'{p}copy({name}), ' for name in old_names)
+            lines.append(f'    {p}old = {p}OldValues(({old_items}))')
+    lines.append(f'    {p}ret = {call_src}')
+    check_lines = []
+    for i, postcondition in enumerate(postconditions):
+        helpers[f'{p}post{i}'] = postcondition.check
+        helpers[f'{p}post{i}_msg'] = 'Postcondition failed at {}:{}'.format(
+            postcondition.condition.filename, postcondition.condition.line)
+        check_lines.append(f'        if not {p}post{i}({post_args_for(postcondition)}):')
+        check_lines.append(f'            raise {p}PostconditionFailed({p}post{i}_msg)')
+    if check_lines:
+        lines.extend(_bracket_checks(check_lines, p))
+    lines.append(f'    return {p}ret')
+    exec('\n'.join(lines), helpers)
+    return cast(Callable, helpers['wrapper'])
+
+
+class EnforcementState(threading.local):
+    '''
+    Per-thread enforcement status: `fns_enforcing` holds the ids of the
+    functions whose conditions are being checked, or is None when
+    enforcement is disabled.
+    '''
+    def __init__(self):
+        self.fns_enforcing: Optional[Set[int]] = set()
 
 
 class EnforcedConditions:
     def __init__(self, *envs, interceptor=lambda x: x):
         self.envs = envs
         self.interceptor = interceptor
-        self.fns_enforcing: Optional[Set[Callable]] = set()
+        self.state = EnforcementState()
         self.wrapper_map: Dict[Callable, Callable] = {}
         self.original_map: Dict[IdentityWrapper[Callable], Callable] = {}
+        self.wrapped_classes: Set[IdentityWrapper[type]] = set()
+        self.depth = 0
 
     def _wrap_class(self, cls: type, class_conditions: ClassConditions) -> None:
         #print('wrapping class ', cls)
-        method_conditions = dict(class_conditions.methods)
-        for method_name, method in list(inspect.getmembers(cls, inspect.isfunction)):
-            conditions = method_conditions.get(method_name)
-            if conditions is None:
+        # (recorded first, so that a partially wrapped class gets unwrapped too)
+        self.wrapped_classes.add(IdentityWrapper(cls))
+        for method_name, conditions in class_conditions.methods.items():
+            method = _find_function(cls, method_name)
+            if method is None:
                 continue
             wrapper = self._wrap_fn(method, conditions)
             setattr(cls, method_name, wrapper)
@@ -95,41 +350,51 @@ class EnforcedConditions:
     def is_enforcement_wrapper(self, value):
         return IdentityWrapper(value) in self.original_map
 
-    @contextlib.contextmanager
-    def currently_enforcing(self, fn: Callable):
-        if self.fns_enforcing is None:
-            yield None
-        else:
-            self.fns_enforcing.add(fn)
-            try:
-                yield None
-            finally:
-                self.fns_enforcing.remove(fn)
-
     @contextlib.contextmanager
     def disabled_enforcement(self):
-        prev = self.fns_enforcing
+        state = self.state
+        prev = state.fns_enforcing
         assert prev is not None
-        self.fns_enforcing = None
+        state.fns_enforcing = None
         try:
             yield None
         finally:
-            self.fns_enforcing = prev
+            state.fns_enforcing = prev
 
     @contextlib.contextmanager
     def enabled_enforcement(self):
-        prev = self.fns_enforcing
+        state = self.state
+        prev = state.fns_enforcing
         assert prev is None
-        self.fns_enforcing = set()
+        state.fns_enforcing = set()
         try:
             yield None
         finally:
-            self.fns_enforcing = prev
+            state.fns_enforcing = prev
 
     def __enter__(self):
-        next_envs = [env.copy() for env in self.envs]
-        for env, next_env in zip(self.envs, next_envs):
-            for (k, v) in env.items():
+        self.depth += 1
+        if self.depth > 1 or not _ENABLED:
+            return self  # (already entered, or disabled)
+        try:
+            self._wrap_envs()
+        except BaseException:
+            # __exit__ won't be called; don't leave the environments half-wrapped:
+            self.depth -= 1
+            self._unwrap_envs()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.depth -= 1
+        if self.depth > 0:
+            return False  # still inside the outermost context
+        self._unwrap_envs()
+        return False
+
+    def _wrap_envs(self) -> None:
+        for env in self.envs:
+            for (k, v) in list(env.items()):
                 if isinstance(v, (types.FunctionType, types.BuiltinFunctionType)):
                     if is_singledispatcher(v):
                         wrapper = self._transform_singledispatch(
@@ -138,51 +403,61 @@ class EnforcedConditions:
                         wrapper = self._wrap_fn(v)
                         if wrapper is v:
                             continue
-                    next_env[k] = wrapper
+                    env[k] = wrapper
                 elif isinstance(v, type):
                     conditions = get_class_conditions(v)
                     if conditions.has_any():
                         self._wrap_class(v, conditions)
-        for env, next_env in zip(self.envs, next_envs):
-            env.update(next_env)
-        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        next_envs = [env.copy() for env in self.envs]
-        for env, next_env in zip(self.envs, next_envs):
+    def _unwrap_envs(self) -> None:
+        if not self.original_map and not self.wrapped_classes:
+            return  # nothing was wrapped
+        for env in self.envs:
             for (k, v) in list(env.items()):
-                next_env[k] = self._unwrap(v)
-        for env, next_env in zip(self.envs, next_envs):
-            env.update(next_env)
-        return False
+                unwrapped = self._unwrap(v)
+                if unwrapped is not v:
+                    env[k] = unwrapped
+        self.wrapped_classes.clear()
 
     def _unwrap(self, value):
+        if not callable(value):  # (classes are callable too)
+            return value
         if self.is_enforcement_wrapper(value):
             return self.original_map[IdentityWrapper(value)]
         elif is_singledispatcher(value):
             return self._transform_singledispatch(value, self._unwrap)
         elif isinstance(value, type):
-            self._unwrap_class(value)
+            if IdentityWrapper(value) in self.wrapped_classes:
+                self._unwrap_class(value)
         return value
 
     def _unwrap_class(self, cls: type):
-        for method_name, method in list(inspect.getmembers(cls, inspect.isfunction)):
+        for method_name, method in list(vars(cls).items()):
             if self.is_enforcement_wrapper(method):
                 setattr(cls, method_name,
                         self.original_map[IdentityWrapper(method)])
 
     def _wrap_fn(self, fn: Callable, conditions: Optional[Conditions] = None) -> Callable:
+        if not _ENABLED:
+            return fn
         wrapper = self.wrapper_map.get(fn)
         if wrapper is not None:
             return wrapper
         if self.is_enforcement_wrapper(fn):
             return fn
 
-        conditions = conditions or get_fn_conditions(fn)
+        conditions = conditions or cached_fn_conditions(fn)
         if conditions and conditions.has_any():
             wrapper = EnforcementWrapper(
                 self.interceptor(fn), conditions, self)
-            functools.update_wrapper(wrapper, fn)
+            # Like functools.update_wrapper(), but without merging __dict__:
+            wrapper.__wrapped__ = fn  # type: ignore
+            wrapper.__name__ = fn.__name__
+            wrapper.__qualname__ = fn.__qualname__
+            wrapper.__module__ = fn.__module__
+            wrapper.__doc__ = fn.__doc__  # (conditions are read from docstrings)
+            # (get_type_hints() doesn't follow __wrapped__)
+            wrapper.__annotations__ = fn.__annotations__
         else:
             wrapper = fn
         self.wrapper_map[fn] = wrapper
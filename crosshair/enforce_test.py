@@ -1,6 +1,14 @@
+import functools
+import inspect
+import sys
+import threading
 import unittest
+import unittest.mock
+from typing import Callable, Dict, List, cast, get_type_hints
 
+from crosshair.condition_parser import ConditionExpr, Conditions, get_fn_conditions
 from crosshair.enforce import *
+from crosshair.enforce import _render_params
 
 
 def foo(x: int) -> int:
@@ -11,6 +19,87 @@ def foo(x: int) -> int:
     return x * 2
 
 
+def scale(x: int, factor: int = 2) -> int:
+    '''
+    pre: factor > 0
+    post: _ == x * factor
+    '''
+    return x * factor
+
+
+def total(first: int, *rest: int, scale: int = 1, **extra: int) -> int:
+    '''
+    pre: scale != 0
+    post: _ == scale * (first + sum(rest) + sum(extra.values()))
+    '''
+    return scale * (first + sum(rest) + sum(extra.values()))
+
+
+def positive_placeholder(_: int) -> int:
+    '''
+    pre: _ > 0
+    post: _ == 0
+    '''
+    return 0
+
+
+def single_digit(x: int) -> int:
+    '''
+    pre: True and x >= 0 and x < 10
+    post: True
+    '''
+    return x
+
+
+def append_one(nums: List[int]) -> None:
+    '''
+    post[nums]: len(nums) == len(__old__.nums) + 1
+    post: __return__ is None
+    '''
+    nums.append(1)
+
+
+class UncopyableLog(list):
+    def __copy__(self):
+        raise Exception('Unexpected copy')
+
+
+def append_tracked(nums: List[int], log: List[str]) -> None:
+    '''
+    post[nums, log]: len(nums) == len(__old__.nums) + 1
+    '''
+    nums.append(1)
+    log.append('appended')
+
+
+def append_via_vars(nums: List[int]) -> None:
+    '''
+    post[nums]: len(nums) == len(vars(__old__)['nums']) + 1
+    '''
+    nums.append(1)
+
+
+def append_counted(nums: List[int]) -> None:
+    '''
+    post[nums]: __old__.count == 0
+    '''
+    nums.append(1)
+
+
+def append_two(nums: List[int]) -> None:
+    '''
+    post[nums]: len(nums) == len(__old__.nums) + 1
+    '''
+    nums.extend([2, 2])
+
+
+def unresolvable(x: 'Undefined') -> int:  # type: ignore
+    '''
+    pre: x
+    '''
+    return 1
+
+
 class Pokeable:
     '''
     inv: self.x >= 0
@@ -27,8 +116,21 @@ class Pokeable:
         self.x += amount
 
 
+class BoundedPokeable(Pokeable):
+    '''
+    inv: self.x <= 10
+    '''
+
+
 class CoreTest(unittest.TestCase):
 
+    def test_is_singledispatcher(self) -> None:
+        @functools.singledispatch
+        def describe(x: object) -> str:
+            return 'object'
+        self.assertTrue(is_singledispatcher(describe))
+        self.assertFalse(is_singledispatcher(foo))
+
     def test_enforce_and_unenforce(self) -> None:
         env = {'foo': foo, 'bar': lambda x: x, 'baz': 42}
         backup = env.copy()
@@ -39,6 +141,45 @@ class CoreTest(unittest.TestCase):
             self.assertEqual(env['foo'](50), 150)  # type:ignore
         self.assertIs(env['foo'], backup['foo'])
 
+    def test_enforcement_can_be_turned_off(self) -> None:
+        env = {'foo': foo}
+        with unittest.mock.patch('crosshair.enforce._ENABLED', False):
+            with EnforcedConditions(env):
+                self.assertIs(env['foo'], foo)
+        self.assertIs(env['foo'], foo)
+
+    def test_reentrant_enforcement(self) -> None:
+        env = {'foo': foo}
+        enforced = EnforcedConditions(env)
+        with enforced:
+            wrapper = env['foo']
+            with enforced:
+                self.assertIs(env['foo'], wrapper)
+            self.assertIs(env['foo'], wrapper)
+            with self.assertRaises(PreconditionFailed):
+                env['foo'](-1)
+        self.assertIs(env['foo'], foo)
+
+    def test_failed_enter_leaves_env_unchanged(self) -> None:
+        env = {'foo': foo, 'unresolvable': unresolvable}
+        enforced = EnforcedConditions(env)
+        with self.assertRaises(NameError):
+            with enforced:
+                pass
+        self.assertIs(env['foo'], foo)
+        self.assertEqual(enforced.depth, 0)
+        # A later attempt still undoes its work:
+        with self.assertRaises(NameError):
+            with enforced:
+                pass
+        self.assertIs(env['foo'], foo)
+
+    def test_wrapper_keeps_type_hints(self) -> None:
+        env = {'foo': foo}
+        with EnforcedConditions(env):
+            self.assertEqual(get_type_hints(env['foo']),
+                             {'x': int, 'return': int})
+
     def test_enforce_conditions(self) -> None:
         env = {'foo': foo}
         self.assertEqual(foo(-1), -2)  # unchecked
@@ -49,6 +190,118 @@ class CoreTest(unittest.TestCase):
             with self.assertRaises(PostconditionFailed):
                 env['foo'](0)
 
+    def test_enforcement_status_is_per_thread(self) -> None:
+        env = {'foo': foo}
+        errors = []
+        def call_in_thread():
+            try:
+                env['foo'](-1)
+            except PreconditionFailed as e:
+                errors.append(e)
+        with EnforcedConditions(env) as enforced:
+            with enforced.disabled_enforcement():
+                self.assertEqual(env['foo'](-1), -2)  # unchecked
+                thread = threading.Thread(target=call_in_thread)
+                thread.start()
+                thread.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_enforce_with_defaults_and_keywords(self) -> None:
+        env = {'scale': scale}
+        with EnforcedConditions(env):
+            self.assertEqual(env['scale'](3), 6)
+            self.assertEqual(env['scale'](3, 3), 9)
+            self.assertEqual(env['scale'](factor=4, x=3), 12)
+            with self.assertRaises(PreconditionFailed):
+                env['scale'](3, factor=0)
+            with self.assertRaises(PreconditionFailed):
+                env['scale'](3, 0)
+
+    def test_enforce_variadic_and_keyword_only(self) -> None:
+        env = {'total': total}
+        with EnforcedConditions(env):
+            self.assertEqual(env['total'](1), 1)
+            self.assertEqual(env['total'](1, 2, 3, scale=2, x=4), 20)
+            with self.assertRaises(PreconditionFailed):
+                env['total'](1, 2, scale=0)
+            with self.assertRaises(TypeError):
+                env['total'](scale=2)
+
+    def test_render_positional_only_params(self) -> None:
+        P = inspect.Parameter
+        sig = inspect.Signature([P('a', P.POSITIONAL_ONLY),
+                                 P('b', P.POSITIONAL_OR_KEYWORD),
+                                 P('kw', P.VAR_KEYWORD)])
+        self.assertEqual(_render_params(sig, '_p_', {}), ('a, /, b, **kw', 'a, b, **kw'))
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'positional-only syntax requires 3.8')
+    def test_enforce_positional_only(self) -> None:
+        namespace: Dict[str, object] = {}
+        exec('def h(a, /, **kw):\n    return a + kw.get("a", 0)', namespace)
+        h = cast(Callable, namespace['h'])
+        pre = ConditionExpr(__file__, 0, 'a > 0', namespace)
+        conditions = Conditions([pre], [], frozenset(), inspect.signature(h), None, [])
+        wrapper = EnforcedConditions()._wrap_fn(h, conditions)
+        self.assertEqual(wrapper(1, a=2), 3)
+        with self.assertRaises(TypeError):
+            wrapper(a=1)
+        with self.assertRaises(PreconditionFailed):
+            wrapper(0)
+
+    def test_enforce_parameter_named_underscore(self) -> None:
+        env = {'positive_placeholder': positive_placeholder}
+        with EnforcedConditions(env):
+            self.assertEqual(env['positive_placeholder'](1), 0)
+            with self.assertRaises(PreconditionFailed):
+                env['positive_placeholder'](-1)
+
+    def test_enforce_conjunctions(self) -> None:
+        env = {'single_digit': single_digit}
+        with EnforcedConditions(env):
+            self.assertEqual(env['single_digit'](5), 5)
+            with self.assertRaises(PreconditionFailed) as context:
+                env['single_digit'](12)
+            self.assertIn('x < 10', str(context.exception))
+
+    def test_enforce_old_and_return(self) -> None:
+        env = {'append_one': append_one, 'append_two': append_two,
+               'append_via_vars': append_via_vars}
+        with EnforcedConditions(env):
+            env['append_one']([])
+            env['append_via_vars']([])
+            with self.assertRaises(PostconditionFailed):
+                env['append_two']([])
+
+    def test_old_only_exposes_parameters(self) -> None:
+        env = {'append_counted': append_counted}
+        with EnforcedConditions(env):
+            with self.assertRaises(AttributeError):
+                env['append_counted']([])
+
+    def test_enforce_snapshots_only_old_references(self) -> None:
+        env = {'append_tracked': append_tracked}
+        log = UncopyableLog()
+        with EnforcedConditions(env):
+            env['append_tracked']([], log)
+        self.assertEqual(log, ['appended'])
+
+    def test_conditions_are_parsed_once(self) -> None:
+        def halve(x: int) -> int:
+            '''
+            pre: x % 2 == 0
+            '''
+            return x // 2
+        env = {'halve': halve}
+        with unittest.mock.patch('crosshair.enforce.get_fn_conditions',
+                                 wraps=get_fn_conditions) as parse:
+            with EnforcedConditions(env):
+                self.assertEqual(env['halve'](4), 2)
+            self.assertEqual(parse.call_count, 1)
+            with EnforcedConditions(env):
+                with self.assertRaises(PreconditionFailed):
+                    env['halve'](3)
+            self.assertEqual(parse.call_count, 1)
+
     def test_class_enforce(self) -> None:
         env = {'Pokeable': Pokeable}
         old_id = id(Pokeable.poke)
@@ -60,6 +313,14 @@ class CoreTest(unittest.TestCase):
                 Pokeable().pokeby(-1)
         self.assertEqual(id(env['Pokeable'].poke), old_id)
 
+    def test_class_enforce_inherited_methods(self) -> None:
+        env = {'BoundedPokeable': BoundedPokeable}
+        with EnforcedConditions(env):
+            with self.assertRaises(PreconditionFailed):
+                BoundedPokeable().pokeby(-1)
+            with self.assertRaises(PostconditionFailed):
+                BoundedPokeable().pokeby(20)
+
 
 if __name__ == '__main__':
     unittest.main()
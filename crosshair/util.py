@@ -4,6 +4,7 @@ import functools
 import os
 import sys
 import traceback
+import types
 from typing import *
 
 
@@ -24,11 +25,16 @@ def set_debug(debug: bool):
 def debug(*a):
     if not _DEBUG:
         return
-    stack = traceback.extract_stack()
-    frame = stack[-2]
-    indent = len(stack) - 3
+    # Walk frames directly; traceback.extract_stack() would also load source lines.
+    frame = sys._getframe(1)
+    depth = 0
+    f: Optional[types.FrameType] = frame
+    while f is not None:
+        depth += 1
+        f = f.f_back
+    indent = depth - 2
     print('|{}|{}() {}'.format(
-        ' ' * indent, frame.name, ' '.join(map(str, a))), file=sys.stderr)
+        ' ' * indent, frame.f_code.co_name, ' '.join(map(str, a))), file=sys.stderr)
 
 
 class NotFound(ValueError):
@@ -38,6 +44,9 @@ class ErrorDuringImport(Exception):
     pass
 
 
+_MISSING = object()
+
+
 def walk_qualname(obj: object, name: str) -> object:
     '''
     >>> walk_qualname(list, 'append') == list.append
@@ -53,9 +62,10 @@ def walk_qualname(obj: object, name: str) -> object:
         if part == '<locals>':
             raise ValueError(
                 'object defined inline are non-addressable(' + name + ')')
-        if not hasattr(obj, part):
+        next_obj = getattr(obj, part, _MISSING)
+        if next_obj is _MISSING:
             raise NotFound('Name "' + part + '" not found')
-        obj = getattr(obj, part)
+        obj = next_obj
     return obj
 
 
@@ -105,32 +115,56 @@ def extract_module_from_file(filename: str) -> Tuple[str, str]:
 
 def memo(f):
     """ Memoization decorator for a function taking a single argument """
-    saved = {}
-    @functools.wraps(f)
-    def memo_wrapper(a):
-        if not a in saved:
-            saved[a] = f(a)
-        return saved[a]
-    return memo_wrapper
+    return functools.lru_cache(maxsize=None)(f)
 
 
 _T = TypeVar('_T')
 
 
 class IdentityWrapper(Generic[_T]):
+    '''
+    >>> a, b = [], []
+    >>> IdentityWrapper(a) == IdentityWrapper(a)
+    True
+    >>> IdentityWrapper(a) == IdentityWrapper(b)
+    False
+    '''
+    __slots__ = ('o', '_h')
+
     def __init__(self, o: _T):
         self.o = o
+        self._h = id(o)
 
     def __hash__(self):
-        return id(self.o)
+        return self._h
 
     def __eq__(self, o):
-        return hash(self) == hash(o)
+        return type(o) is IdentityWrapper and self.o is o.o
+
+class AttributeHolder(types.SimpleNamespace):
+    '''
+    >>> import copy, pickle
+    >>> holder = AttributeHolder({'x': [1]})
+    >>> holder.x
+    [1]
+    >>> copy.copy(holder).x is holder.x
+    True
+    >>> copy.deepcopy(holder).x == holder.x
+    True
+    >>> pickle.loads(pickle.dumps(holder)).x
+    [1]
+    >>> {holder: 1}[holder]
+    1
+    >>> holder == AttributeHolder({'x': [1]})
+    False
+    '''
+    # Holders compare by identity (and are hashable), unlike SimpleNamespace:
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
 
-class AttributeHolder:
-    def __init__(self, attrs: Mapping[str, object]):
-        for (k, v) in attrs.items():
-            self.__dict__[k] = v
+    # (the default lets SimpleNamespace.__reduce__ recreate us for copy and pickle)
+    def __init__(self, attrs: Mapping[str, object] = {}):
+        types.SimpleNamespace.__init__(self, **attrs)
 
 
 class CrosshairInternal(Exception):
@@ -153,8 +187,9 @@ class PathTimeout(UnexploredPath):
 
 class CrosshairUnsupported(UnexploredPath):
     def __init__(self, *a):
-        debug('CrosshairUnsupported. Stack trace:\n' +
-              ''.join(traceback.format_stack()))
+        if _DEBUG:
+            debug('CrosshairUnsupported. Stack trace:\n' +
+                  ''.join(traceback.format_stack()))
 
 
 class IgnoreAttempt(Exception):